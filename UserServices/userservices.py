@@ -1,22 +1,121 @@
-from flask import Flask, request, jsonify
-from flask_cors import CORS
-from pymongo import MongoClient
+from quart import Quart, Response, request, jsonify
+from quart_cors import cors
+from flask_orjson import OrjsonProvider
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import DuplicateKeyError
 from bson import ObjectId
 from datetime import datetime, timezone
 import os
+import hmac
+import re
 import logging
 import jwt
 from functools import wraps
 from typing import Dict, Any, Optional
+from cachetools import TTLCache
+from cachetools.func import ttl_cache
+import time
+import orjson
+import msgpack
+import msgspec
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-now_utc = datetime.now(timezone.utc).isoformat()
+# Single-slot cache of (epoch second, ISO timestamp for that second)
+_now_iso_cache = (0, '')
 
-app = Flask(__name__)
-CORS(app)
+
+def _now_iso() -> str:
+    """Current UTC time as an ISO 8601 string, formatted at most once per second"""
+    global _now_iso_cache
+    second = int(time.time())
+    if _now_iso_cache[0] != second:
+        _now_iso_cache = (second, datetime.fromtimestamp(second, timezone.utc).isoformat())
+    return _now_iso_cache[1]
+
+
+def json_serial(obj):
+    """JSON serializer for objects not serializable by default json code"""
+    if isinstance(obj, datetime):
+        # Match the JSON provider (OPT_NAIVE_UTC | OPT_UTC_Z): naive means UTC, UTC is "Z"
+        if obj.tzinfo is None:
+            obj = obj.replace(tzinfo=timezone.utc)
+        iso = obj.isoformat()
+        return iso[:-6] + 'Z' if iso.endswith('+00:00') else iso
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError(f"Type {type(obj)} not serializable")
+
+
+class PreferencesUpdate(msgspec.Struct):
+    """Fields accepted by a preferences update; fields left out stay UNSET"""
+    default_order_qty: int | msgspec.UnsetType = msgspec.UNSET
+    favorite_symbols: list[str] | msgspec.UnsetType = msgspec.UNSET
+    confirm_market_orders: bool | msgspec.UnsetType = msgspec.UNSET
+    ui_preferences: dict | msgspec.UnsetType = msgspec.UNSET
+    risk_preferences: dict | msgspec.UnsetType = msgspec.UNSET
+
+
+# ASCII-only upper-casing table for ticker symbols
+_UPPER_TABLE = bytes.maketrans(b'abcdefghijklmnopqrstuvwxyz', b'ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+
+
+def normalize_symbol(symbol: Any) -> Optional[str]:
+    """Upper-case an ASCII ticker symbol; returns None for any other input"""
+    if not isinstance(symbol, str) or not symbol.isascii():
+        return None
+    return symbol.encode('ascii').translate(_UPPER_TABLE).decode('ascii')
+
+
+def default_preferences(username: str) -> Dict[str, Any]:
+    """Preferences returned for users who have not saved any yet"""
+    return {
+        "username": username,
+        "default_order_qty": 100,
+        "favorite_symbols": [],
+        "confirm_market_orders": True,
+        "ui_preferences": {
+            "dark_mode": False,
+            "layout": "default"
+        },
+        "risk_preferences": {
+            "soft_limit_warning": True,
+            "max_position_size": 10000
+        }
+    }
+
+
+def wants_msgpack() -> bool:
+    """Check whether the client prefers MessagePack over JSON via the Accept header"""
+    best = request.accept_mimetypes.best_match(['application/json', 'application/msgpack'])
+    return best == 'application/msgpack'
+
+
+class UserServiceJSONProvider(OrjsonProvider):
+    """orjson-backed JSON provider; datetimes are emitted natively as UTC ISO strings"""
+    # No OPT_INDENT_2 / OPT_SORT_KEYS: output stays compact and in document order
+    option = orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z
+    default = staticmethod(json_serial)
+
+
+app = Quart(__name__)
+app.json_provider_class = UserServiceJSONProvider
+app.json = UserServiceJSONProvider(app)
+app = cors(app)
+
+# Bodies of frequently returned errors, serialized once at import
+_INVALID_TOKEN_BODY = orjson.dumps({"error": "Unauthorized - Invalid or missing token"})
+_INVALID_SERVICE_KEY_BODY = orjson.dumps({"error": "Unauthorized - Invalid service key"})
+_FORBIDDEN_BODY = orjson.dumps({"error": "Forbidden - Cannot access other user's data"})
+_NO_DATA_BODY = orjson.dumps({"error": "No data provided"})
+_PROFILE_NOT_FOUND_BODY = orjson.dumps({"error": "User profile not found"})
+
+
+def error_response(body: bytes, status: int) -> Response:
+    """Wrap a pre-serialized JSON error body in a fresh response"""
+    return Response(body, status=status, mimetype='application/json')
 
 # MongoDB connection
 MONGO_URI = os.getenv('MONGO_URI', 'mongodb://mongodb:27017')
@@ -25,27 +124,80 @@ DB_NAME = os.getenv('DB_NAME', 'userdb')
 # JWT Configuration - should match auth service secret
 JWT_SECRET = os.getenv('JWT_SECRET', 'supersecretkey')
 JWT_ALGORITHM = 'HS256'
+_JWT_ALGORITHMS = [JWT_ALGORITHM]
+_JWT_OPTIONS = {"verify_signature": True, "verify_exp": True}
+
+# "Bearer <token>" with the token limited to the JWT (base64url + '.') alphabet
+_BEARER_RE = re.compile(r'Bearer\s+([A-Za-z0-9._\-]+)', re.IGNORECASE)
 
 # Service-to-service authentication
 SERVICE_SECRET = os.getenv('SERVICE_SECRET', 'service-secret-key')
+_SERVICE_SECRET_BYTES = SERVICE_SECRET.encode()
 
-try:
-    client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000)
-    db = client[DB_NAME]
-    profiles_collection = db['user_profiles']
-    preferences_collection = db['user_preferences']
-    # Test connection
-    client.admin.command('ping')
-    logger.info("Connected to MongoDB successfully")
-except Exception as e:
-    logger.error(f"MongoDB connection error: {e}")
+# Short-lived per-process caches of profile / preferences documents by username.
+# Each worker process has its own caches, so after a write other workers may
+# serve the previous document (even to the user who wrote it) for up to the TTL.
+_profile_cache = TTLCache(maxsize=5000, ttl=30)
+_prefs_cache = TTLCache(maxsize=5000, ttl=30)
 
+# Bumped on every eviction; reads only populate a cache if no write finished meanwhile
+_cache_writes = 0
+
+
+def invalidate_cached(cache: TTLCache, username: str):
+    """Evict a user's cached document after a write to it"""
+    global _cache_writes
+    _cache_writes += 1
+    cache.pop(username, None)
+
+# Last successful health-check ping: [monotonic time, healthy]
+HEALTH_PING_INTERVAL = 5
+_last_ping = [0.0, False]
+
+client = AsyncIOMotorClient(MONGO_URI, serverSelectionTimeoutMS=5000)
+db = client[DB_NAME]
+profiles_collection = db['user_profiles']
+preferences_collection = db['user_preferences']
+
+# Set once the unique username indexes are known to exist
+_indexes_ready = False
 
-def json_serial(obj):
-    """JSON serializer for objects not serializable by default json code"""
-    if isinstance(obj, (datetime, ObjectId)):
-        return str(obj)
-    raise TypeError(f"Type {type(obj)} not serializable")
+
+async def ensure_indexes() -> bool:
+    """Create the unique username indexes if needed; returns whether they exist"""
+    global _indexes_ready
+    if not _indexes_ready:
+        try:
+            await profiles_collection.create_index("username", unique=True)
+            await preferences_collection.create_index("username", unique=True)
+            _indexes_ready = True
+        except Exception as e:
+            logger.error(f"Error creating MongoDB indexes: {e}")
+    return _indexes_ready
+
+
+@app.before_serving
+async def connect_to_mongo():
+    """Verify the MongoDB connection once the event loop is running"""
+    try:
+        await client.admin.command('ping')
+        logger.info("Connected to MongoDB successfully")
+    except Exception as e:
+        logger.error(f"MongoDB connection error: {e}")
+    
+    # Retried on registration if this fails (e.g. MongoDB not up yet)
+    await ensure_indexes()
+
+
+@ttl_cache(maxsize=4096, ttl=30)
+def _decode_and_verify(token: str) -> Dict[str, Any]:
+    """Decode and verify a JWT; results are cached, raised errors are not"""
+    return jwt.decode(
+        token,
+        JWT_SECRET,
+        algorithms=_JWT_ALGORITHMS,
+        options=_JWT_OPTIONS
+    )
 
 
 def get_username_from_token() -> Optional[str]:
@@ -55,20 +207,20 @@ def get_username_from_token() -> Optional[str]:
         return None
     
     # Extract token from "Bearer <token>" format
-    parts = auth_header.split()
-    if len(parts) != 2 or parts[0].lower() != 'bearer':
+    match = _BEARER_RE.fullmatch(auth_header)
+    if not match:
         return None
     
-    token = parts[1]
+    token = match.group(1)
     
     try:
-        # Decode and verify JWT token
-        decoded_token = jwt.decode(
-            token,
-            JWT_SECRET,
-            algorithms=[JWT_ALGORITHM],
-            options={"verify_signature": True, "verify_exp": True}
-        )
+        # Decode and verify JWT token (cached for repeat tokens)
+        decoded_token = _decode_and_verify(token)
+        
+        # A cached token may have expired since it was verified
+        if decoded_token.get('exp', float('inf')) <= time.time():
+            logger.warning("JWT token has expired")
+            return None
         
         # Extract username from token (can be in 'username' or 'sub' field)
         username = decoded_token.get('username') or decoded_token.get('sub')
@@ -87,13 +239,14 @@ def get_username_from_token() -> Optional[str]:
 def require_service_auth(f):
     """Decorator to require service-to-service authentication"""
     @wraps(f)
-    def decorated_function(*args, **kwargs):
+    async def decorated_function(*args, **kwargs):
         service_key = request.headers.get('X-Service-Key')
         
-        if not service_key or service_key != SERVICE_SECRET:
-            return jsonify({"error": "Unauthorized - Invalid service key"}), 401
+        # Constant-time compare; bytes so non-ASCII header values cannot raise
+        if not service_key or not hmac.compare_digest(service_key.encode(), _SERVICE_SECRET_BYTES):
+            return error_response(_INVALID_SERVICE_KEY_BODY, 401)
         
-        return f(*args, **kwargs)
+        return await f(*args, **kwargs)
     
     return decorated_function
 
@@ -101,50 +254,58 @@ def require_service_auth(f):
 def require_auth(f):
     """Decorator to require JWT authentication"""
     @wraps(f)
-    def decorated_function(*args, **kwargs):
+    async def decorated_function(*args, **kwargs):
         username_from_token = get_username_from_token()
         
         if not username_from_token:
-            return jsonify({"error": "Unauthorized - Invalid or missing token"}), 401
+            return error_response(_INVALID_TOKEN_BODY, 401)
         
         # Get username from route parameter if it exists
         route_username = kwargs.get('username')
         
         # If route has username parameter, verify it matches token
         if route_username and username_from_token != route_username:
-            return jsonify({"error": "Forbidden - Cannot access other user's data"}), 403
+            return error_response(_FORBIDDEN_BODY, 403)
         
         # Add username to kwargs for use in the route
         kwargs['authenticated_username'] = username_from_token
-        return f(*args, **kwargs)
+        return await f(*args, **kwargs)
     
     return decorated_function
 
 
 @app.route('/health', methods=['GET'])
-def health_check():
+async def health_check():
     """Health check endpoint"""
+    # Reuse a recent successful ping so frequent probes don't hit MongoDB each time
+    if _last_ping[1] and time.monotonic() - _last_ping[0] < HEALTH_PING_INTERVAL:
+        return jsonify({"status": "healthy", "service": "user-service"}), 200
+    
     try:
-        client.admin.command('ping')
+        await client.admin.command('ping')
+        _last_ping[0] = time.monotonic()
+        _last_ping[1] = True
         return jsonify({"status": "healthy", "service": "user-service"}), 200
     except Exception as e:
+        _last_ping[1] = False
         return jsonify({"status": "unhealthy", "error": str(e)}), 503
 
 
 @app.route('/profile/<username>', methods=['GET'])
 @require_auth
-def get_user_profile(username: str, authenticated_username: str):
+async def get_user_profile(username: str, authenticated_username: str):
     """Get user profile data"""
     try:
-        profile = profiles_collection.find_one({"username": username})
-        
-        if not profile:
-            return jsonify({"error": "User profile not found"}), 404
-        
-        # Remove MongoDB _id and convert to JSON-serializable format
-        profile.pop('_id', None)
-        if 'created_at' in profile:
-            profile['created_at'] = str(profile['created_at'])
+        profile = _profile_cache.get(username)
+        if profile is None:
+            writes_before = _cache_writes
+            profile = await profiles_collection.find_one({"username": username}, {"_id": 0})
+            
+            if not profile:
+                return error_response(_PROFILE_NOT_FOUND_BODY, 404)
+            
+            if _cache_writes == writes_before:
+                _profile_cache[username] = profile
         
         return jsonify(profile), 200
     except Exception as e:
@@ -154,13 +315,13 @@ def get_user_profile(username: str, authenticated_username: str):
 
 @app.route('/profile/<username>', methods=['PUT'])
 @require_auth
-def update_user_profile(username: str, authenticated_username: str):
+async def update_user_profile(username: str, authenticated_username: str):
     """Update user profile data"""
     try:
-        data = request.get_json()
+        data = await request.get_json()
         
         if not data:
-            return jsonify({"error": "No data provided"}), 400
+            return error_response(_NO_DATA_BODY, 400)
         
         # Allowed fields for profile update
         allowed_fields = ['display_name', 'email', 'timezone', 'country']
@@ -170,16 +331,17 @@ def update_user_profile(username: str, authenticated_username: str):
             return jsonify({"error": "No valid fields to update"}), 400
         
         # Add updated timestamp
-        update_data['updated_at'] = datetime.utcnow()
+        update_data['updated_at'] = _now_iso()
         
-        result = profiles_collection.update_one(
+        result = await profiles_collection.update_one(
             {"username": username},
             {"$set": update_data},
             upsert=False
         )
+        invalidate_cached(_profile_cache, username)
         
         if result.matched_count == 0:
-            return jsonify({"error": "User profile not found"}), 404
+            return error_response(_PROFILE_NOT_FOUND_BODY, 404)
         
         return jsonify({"message": "Profile updated successfully"}), 200
     except Exception as e:
@@ -189,33 +351,39 @@ def update_user_profile(username: str, authenticated_username: str):
 
 @app.route('/profile/internal', methods=['POST'])
 @require_service_auth
-def create_user_profile_internal():
+async def create_user_profile_internal():
     """Internal endpoint for service-to-service calls (e.g., from auth service during registration)"""
     try:
-        data = request.get_json()
+        data = await request.get_json()
         
         if not data or 'username' not in data:
             return jsonify({"error": "Username is required"}), 400
         
         username = data['username']
         
-        # Check if profile already exists
-        existing = profiles_collection.find_one({"username": username})
-        if existing:
-            return jsonify({"error": "User profile already exists"}), 409
-        
         # Create new profile
+        now = _now_iso()
         profile = {
             "username": username,
             "display_name": data.get('display_name', username),
             "email": data.get('email', ''),
             "timezone": data.get('timezone', 'UTC'),
             "country": data.get('country', ''),
-            "created_at": datetime.now(timezone.utc).isoformat(),
-            "updated_at": datetime.now(timezone.utc).isoformat()
+            "created_at": now,
+            "updated_at": now
         }
         
-        profiles_collection.insert_one(profile)
+        # Until the unique index exists, fall back to an explicit check
+        if not await ensure_indexes():
+            existing = await profiles_collection.find_one({"username": username}, {"_id": 1})
+            if existing:
+                return jsonify({"error": "User profile already exists"}), 409
+        
+        # The unique index on username rejects duplicates
+        try:
+            await profiles_collection.insert_one(profile)
+        except DuplicateKeyError:
+            return jsonify({"error": "User profile already exists"}), 409
         profile.pop('_id', None)
         
         return jsonify(profile), 201
@@ -226,35 +394,30 @@ def create_user_profile_internal():
 
 @app.route('/preferences/<username>', methods=['GET'])
 @require_auth
-def get_user_preferences(username: str, authenticated_username: str):
+async def get_user_preferences(username: str, authenticated_username: str):
     """Get user preferences"""
     try:
-        preferences = preferences_collection.find_one({"username": username})
+        preferences = _prefs_cache.get(username)
+        if preferences is None:
+            writes_before = _cache_writes
+            preferences = await preferences_collection.find_one({"username": username}, {"_id": 0})
+            if preferences and _cache_writes == writes_before:
+                _prefs_cache[username] = preferences
         
         if not preferences:
             # Return default preferences if none exist
-            default_prefs = {
-                "username": username,
-                "default_order_qty": 100,
-                "favorite_symbols": [],
-                "confirm_market_orders": True,
-                "ui_preferences": {
-                    "dark_mode": False,
-                    "layout": "default"
-                },
-                "risk_preferences": {
-                    "soft_limit_warning": True,
-                    "max_position_size": 10000
-                }
-            }
-            return jsonify(default_prefs), 200
-        
-        # Remove MongoDB _id
-        preferences.pop('_id', None)
-        if 'updated_at' in preferences:
-            preferences['updated_at'] = str(preferences['updated_at'])
-        
-        return jsonify(preferences), 200
+            preferences = default_preferences(username)
+        
+        # Service consumers can ask for MessagePack to skip JSON parsing
+        if wants_msgpack():
+            body = msgpack.packb(preferences, default=json_serial)
+            response = Response(body, status=200, mimetype='application/msgpack')
+        else:
+            response = jsonify(preferences)
+        
+        # The body format depends on Accept, so caches must key on it
+        response.vary.add('Accept')
+        return response, 200
     except Exception as e:
         logger.error(f"Error fetching user preferences: {e}")
         return jsonify({"error": "Internal server error"}), 500
@@ -262,51 +425,37 @@ def get_user_preferences(username: str, authenticated_username: str):
 
 @app.route('/preferences/<username>', methods=['PUT'])
 @require_auth
-def update_user_preferences(username: str, authenticated_username: str):
+async def update_user_preferences(username: str, authenticated_username: str):
     """Update user preferences"""
     try:
-        data = request.get_json()
+        body = await request.get_data()
         
-        if not data:
-            return jsonify({"error": "No data provided"}), 400
-        
-        # Define allowed fields and their types
-        allowed_fields = {
-            'default_order_qty': int,
-            'favorite_symbols': list,
-            'confirm_market_orders': bool,
-            'ui_preferences': dict,
-            'risk_preferences': dict
-        }
+        if not body:
+            return error_response(_NO_DATA_BODY, 400)
         
-        # Validate and filter update data
-        update_data = {}
-        for field, field_type in allowed_fields.items():
-            if field in data:
-                if isinstance(data[field], field_type):
-                    update_data[field] = data[field]
-                else:
-                    return jsonify({"error": f"Invalid type for {field}"}), 400
+        # Decode and type-check in one pass; unknown fields are ignored
+        try:
+            update = msgspec.json.decode(body, type=PreferencesUpdate)
+        except msgspec.ValidationError as e:
+            return jsonify({"error": str(e)}), 400
+        except msgspec.DecodeError:
+            return jsonify({"error": "Invalid JSON"}), 400
+        
+        update_data = msgspec.to_builtins(update)
         
         if not update_data:
             return jsonify({"error": "No valid fields to update"}), 400
         
         # Add updated timestamp
-        update_data['updated_at'] = now_utc
+        update_data['updated_at'] = _now_iso()
         
-        # Upsert: create if doesn't exist, update if it does
-        result = preferences_collection.update_one(
+        # Upsert: create if doesn't exist (with username), update if it does
+        await preferences_collection.update_one(
             {"username": username},
-            {"$set": update_data},
+            {"$set": update_data, "$setOnInsert": {"username": username}},
             upsert=True
         )
-        
-        # If it was an insert, also set username
-        if result.upserted_id:
-            preferences_collection.update_one(
-                {"username": username},
-                {"$set": {"username": username}}
-            )
+        invalidate_cached(_prefs_cache, username)
         
         return jsonify({"message": "Preferences updated successfully"}), 200
     except Exception as e:
@@ -316,38 +465,29 @@ def update_user_preferences(username: str, authenticated_username: str):
 
 @app.route('/preferences/<username>/favorites', methods=['POST'])
 @require_auth
-def add_favorite_symbol(username: str, authenticated_username: str):
+async def add_favorite_symbol(username: str, authenticated_username: str):
     """Add a symbol to user's favorites"""
     try:
-        data = request.get_json()
+        data = await request.get_json()
         
         if not data or 'symbol' not in data:
             return jsonify({"error": "Symbol is required"}), 400
         
-        symbol = data['symbol'].upper()
+        symbol = normalize_symbol(data['symbol'])
+        if symbol is None:
+            return jsonify({"error": "Symbol must be an ASCII string"}), 400
         
-        result = preferences_collection.update_one(
+        # Upsert seeds username from the filter, so a missing preferences
+        # document is created by this single write
+        await preferences_collection.update_one(
             {"username": username},
             {
                 "$addToSet": {"favorite_symbols": symbol},
-                "$set": {"updated_at": now_utc}
+                "$set": {"updated_at": _now_iso()}
             },
             upsert=True
         )
-        
-        if result.matched_count == 0 and not result.upserted_id:
-            # Initialize preferences if they don't exist
-            preferences_collection.update_one(
-                {"username": username},
-                {
-                    "$set": {
-                        "username": username,
-                        "favorite_symbols": [symbol],
-                        "updated_at": now_utc
-                    }
-                },
-                upsert=True
-            )
+        invalidate_cached(_prefs_cache, username)
         
         return jsonify({"message": f"Symbol {symbol} added to favorites"}), 200
     except Exception as e:
@@ -357,18 +497,21 @@ def add_favorite_symbol(username: str, authenticated_username: str):
 
 @app.route('/preferences/<username>/favorites/<symbol>', methods=['DELETE'])
 @require_auth
-def remove_favorite_symbol(username: str, symbol: str, authenticated_username: str):
+async def remove_favorite_symbol(username: str, symbol: str, authenticated_username: str):
     """Remove a symbol from user's favorites"""
     try:
-        symbol = symbol.upper()
+        symbol = normalize_symbol(symbol)
+        if symbol is None:
+            return jsonify({"error": "Symbol must be an ASCII string"}), 400
         
-        result = preferences_collection.update_one(
+        result = await preferences_collection.update_one(
             {"username": username},
             {
                 "$pull": {"favorite_symbols": symbol},
-                "$set": {"updated_at": now_utc}
+                "$set": {"updated_at": _now_iso()}
             }
         )
+        invalidate_cached(_prefs_cache, username)
         
         if result.matched_count == 0:
             return jsonify({"error": "User preferences not found"}), 404
@@ -379,6 +522,37 @@ def remove_favorite_symbol(username: str, symbol: str, authenticated_username: s
         return jsonify({"error": "Internal server error"}), 500
 
 
+@app.route('/me/<username>', methods=['GET'])
+@require_auth
+async def get_user_overview(username: str, authenticated_username: str):
+    """Get user profile and preferences in a single request"""
+    try:
+        # Join preferences onto the profile in one aggregation round-trip
+        cursor = profiles_collection.aggregate([
+            {"$match": {"username": username}},
+            {"$lookup": {
+                "from": "user_preferences",
+                "localField": "username",
+                "foreignField": "username",
+                "as": "preferences"
+            }},
+            {"$project": {"_id": 0, "preferences._id": 0}}
+        ], batchSize=1)
+        docs = await cursor.to_list(length=1)
+        
+        if not docs:
+            return error_response(_PROFILE_NOT_FOUND_BODY, 404)
+        
+        overview = docs[0]
+        matched = overview['preferences']
+        overview['preferences'] = matched[0] if matched else default_preferences(username)
+        
+        return jsonify(overview), 200
+    except Exception as e:
+        logger.error(f"Error fetching user overview: {e}")
+        return jsonify({"error": "Internal server error"}), 500
+
+
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 8081))
     app.run(host='0.0.0.0', port=port, debug=False)